@@ -35,6 +35,13 @@ from bika.lims.content.bikaschema import BikaFolderSchema
 from bika.lims.content.bikaschema import BikaSchema
 from bika.lims.interfaces import IOrganisation
 
+
+def address_widget(label):
+    """Returns the widget for an address field with the label passed in
+    """
+    return AddressWidget(label=label)
+
+
 schema = BikaFolderSchema.copy() + BikaSchema.copy() + ManagedSchema((
 
     StringField(
@@ -79,9 +86,7 @@ schema = BikaFolderSchema.copy() + BikaSchema.copy() + ManagedSchema((
     AddressField(
         "PhysicalAddress",
         schemata="Address",
-        widget=AddressWidget(
-            label=_("Physical address"),
-        ),
+        widget=address_widget(_("Physical address")),
         subfield_validators={
             "country": "inline_field_validator",
             "state": "inline_field_validator",
@@ -92,9 +97,7 @@ schema = BikaFolderSchema.copy() + BikaSchema.copy() + ManagedSchema((
     AddressField(
         "PostalAddress",
         schemata="Address",
-        widget=AddressWidget(
-            label=_("Postal address"),
-        ),
+        widget=address_widget(_("Postal address")),
         subfield_validators={
             "country": "inline_field_validator",
             "state": "inline_field_validator",
@@ -105,9 +108,7 @@ schema = BikaFolderSchema.copy() + BikaSchema.copy() + ManagedSchema((
     AddressField(
         "BillingAddress",
         schemata="Address",
-        widget=AddressWidget(
-            label=_("Billing address"),
-        ),
+        widget=address_widget(_("Billing address")),
         subfield_validators={
             "country": "inline_field_validator",
             "state": "inline_field_validator",
@@ -173,13 +174,15 @@ class Organisation(ATFolder):
     security = ClassSecurityInfo()
     displayContentsTab = False
     schema = schema
+    _possible_addresses = ("PhysicalAddress", "PostalAddress", "BillingAddress")
 
     def Title(self):
         """Return the name of the Organisation
         """
-        field = self.getField("Name")
-        field = field and field.get(self) or ""
-        return safe_unicode(field).encode("utf-8")
+        # Lookup the field in the class schema of the instance directly instead
+        # of calling `getField`, that builds the schema on every call
+        name = self.schema["Name"].get(self) or ""
+        return safe_unicode(name).encode("utf-8")
 
     def setTitle(self, value):
         """Set the name of the Organisation
@@ -189,7 +192,7 @@ class Organisation(ATFolder):
     def getPossibleAddresses(self):
         """Get the possible address fields
         """
-        return ["PhysicalAddress", "PostalAddress", "BillingAddress"]
+        return self._possible_addresses
 
     def getPrintAddress(self):
         """Get an address for printing
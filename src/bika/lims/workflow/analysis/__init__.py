@@ -20,3 +20,5 @@
 
 STATE_REJECTED = 'rejected'
 STATE_RETRACTED = 'retracted'
+STATE_VERIFIED = 'verified'
+STATE_PUBLISHED = 'published'
@@ -18,6 +18,11 @@
 # Copyright 2018-2024 by it's authors.
 # Some rights reserved, see README and LICENSE.
 
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import chain
+
+from Acquisition import aq_base
 from bika.lims import api
 from bika.lims.interfaces import IDuplicateAnalysis
 from bika.lims.interfaces import IRejected
@@ -27,23 +32,87 @@ from bika.lims.interfaces import IVerified
 from bika.lims.interfaces.analysis import IRequestAnalysis
 from bika.lims.utils.analysis import create_retest
 from bika.lims.workflow import doActionFor
+from bika.lims.workflow.analysis import STATE_PUBLISHED
 from bika.lims.workflow.analysis import STATE_REJECTED
 from bika.lims.workflow.analysis import STATE_RETRACTED
+from bika.lims.workflow.analysis import STATE_VERIFIED
 from DateTime import DateTime
+from plone.memoize.request import cache
+from zope.annotation.interfaces import IAnnotations
 from zope.interface import alsoProvides
 
+CASCADE_KEY = "senaite.core.workflow.analysis.cascade"
+
+# Statuses of analyses that provide IVerified
+VERIFIED_STATES = (STATE_VERIFIED, STATE_PUBLISHED)
+
+# Statuses of analyses that are not considered for the sample verification
+INVALID_STATES = (STATE_REJECTED, STATE_RETRACTED)
+
+# Indexes of samples that depend on the assignment of their analyses
+ASSIGNMENT_IDXS = ["assigned_state"]
+
+# Mapping of (interface, class) -> whether the class implements the interface
+_implemented_by_cache = {}
+
+
+def provides(interface, obj):
+    """Returns whether the class of the object implements the interface passed
+    in. The result is cached per class, so this is only suitable for
+    interfaces declared on content classes, not for marker interfaces that are
+    provided directly by the objects (e.g. `ISubmitted`)
+    """
+    klass = obj.__class__
+    key = (interface, klass)
+    implemented = _implemented_by_cache.get(key)
+    if implemented is None:
+        implemented = interface.implementedBy(klass)
+        _implemented_by_cache[key] = implemented
+    return implemented
+
+
+def get_worksheet(analysis):
+    """Returns the worksheet the analysis is assigned to, if any. The worksheet
+    is resolved from its UID only once per request
+    """
+    if provides(IDuplicateAnalysis, analysis):
+        # Duplicates are stored inside the worksheet
+        return analysis.getWorksheet()
+
+    worksheet_uid = analysis.getWorksheetUID()
+    if not worksheet_uid:
+        return None
+    return get_worksheet_by_uid(analysis, worksheet_uid)
+
+
+def _worksheet_cache_key(fun, analysis, worksheet_uid):
+    """Cache key generator for the request cache of worksheets
+    """
+    return worksheet_uid
+
+
+@cache(get_key=_worksheet_cache_key, get_request="analysis.REQUEST")
+def get_worksheet_by_uid(analysis, worksheet_uid):
+    """Returns the worksheet for the given UID and caches it on the request.
+
+    Note: The request is obtained by the given expression from the `locals()`,
+          which includes the given arguments.
+    """
+    return api.get_object_by_uid(worksheet_uid, None)
+
 
 def after_assign(analysis):
     """Function triggered after an 'assign' transition for the analysis passed
     in is performed.
     """
-    reindex_request(analysis)
+    # Only the assigned state of the sample (and ancestors) changes
+    reindex_request(analysis, idxs=ASSIGNMENT_IDXS)
 
 
 def before_unassign(analysis):
     """Function triggered before 'unassign' transition takes place
     """
-    worksheet = analysis.getWorksheet()
+    worksheet = get_worksheet(analysis)
     if not worksheet:
         return
 
@@ -55,7 +124,7 @@ def before_unassign(analysis):
 def before_reject(analysis):
     """Function triggered before 'unassign' transition takes place
     """
-    worksheet = analysis.getWorksheet()
+    worksheet = get_worksheet(analysis)
     if not worksheet:
         return
 
@@ -83,18 +152,23 @@ def after_retest(analysis):
         # Create the retest
         create_retest(relative)
 
-    # Retest and auto-verify relatives, from bottom to top
-    relatives = list(reversed(analysis.getDependents(recursive=True)))
-    relatives.extend(analysis.getDependencies(recursive=True))
-    map(verify_and_retest, relatives)
+    # Retest and auto-verify relatives, from bottom to top. Note both lists
+    # are resolved before any retest is created
+    dependents = analysis.getDependents(recursive=True)
+    dependencies = analysis.getDependencies(recursive=True)
+    for relative in chain(reversed(dependents), dependencies):
+        verify_and_retest(relative)
 
     # Create the retest
     create_retest(analysis)
 
     # Try to rollback the Analysis Request
-    if IRequestAnalysis.providedBy(analysis):
-        doActionFor(analysis.getRequest(), "rollback_to_receive")
-        reindex_request(analysis)
+    if not provides(IRequestAnalysis, analysis):
+        return
+
+    sample = analysis.getRequest()
+    doActionFor(sample, "rollback_to_receive")
+    reindex_request(analysis, sample=sample)
 
 
 def after_unassign(analysis):
@@ -104,7 +178,7 @@ def after_unassign(analysis):
     # Remove from the worksheet
     remove_analysis_from_worksheet(analysis)
     # Reindex the Analysis Request
-    reindex_request(analysis)
+    reindex_request(analysis, idxs=ASSIGNMENT_IDXS)
 
 
 def after_cancel(analysis):
@@ -142,15 +216,18 @@ def after_submit(analysis):
     promote_to_dependencies(analysis, "submit")
 
     # Promote transition to worksheet
-    ws = analysis.getWorksheet()
+    ws = get_worksheet(analysis)
     if ws:
         doActionFor(ws, "submit")
         ws.reindexObject()
 
     # Promote transition to Analysis Request
-    if IRequestAnalysis.providedBy(analysis):
-        doActionFor(analysis.getRequest(), 'submit')
-        reindex_request(analysis)
+    if not provides(IRequestAnalysis, analysis):
+        return
+
+    sample = analysis.getRequest()
+    doActionFor(sample, "submit")
+    reindex_request(analysis, sample=sample)
 
 
 def after_retract(analysis):
@@ -167,19 +244,25 @@ def after_retract(analysis):
     for attachment in analysis.getAttachment():
         attachment.setRenderInReport(False)
 
-    # Retract our dependents (analyses that depend on this analysis)
-    cascade_to_dependents(analysis, "retract")
+    # Use a single cascade for dependents and dependencies, so analyses that
+    # are reached through both are only retracted once
+    with transitions_cascade():
+        # Retract our dependents (analyses that depend on this analysis)
+        cascade_to_dependents(analysis, "retract")
 
-    # Retract our dependencies (analyses this analysis depends on)
-    promote_to_dependencies(analysis, "retract")
+        # Retract our dependencies (analyses this analysis depends on)
+        promote_to_dependencies(analysis, "retract")
 
     # Create the retest
     create_retest(analysis)
 
     # Try to rollback the Analysis Request
-    if IRequestAnalysis.providedBy(analysis):
-        doActionFor(analysis.getRequest(), "rollback_to_receive")
-        reindex_request(analysis)
+    if not provides(IRequestAnalysis, analysis):
+        return
+
+    sample = analysis.getRequest()
+    doActionFor(sample, "rollback_to_receive")
+    reindex_request(analysis, sample=sample)
 
 
 def after_reject(analysis):
@@ -198,16 +281,22 @@ def after_reject(analysis):
     # Reject our dependents (analyses that depend on this analysis)
     cascade_to_dependents(analysis, "reject")
 
-    if IRequestAnalysis.providedBy(analysis):
-        # Try verify (for when remaining analyses are in 'verified')
-        doActionFor(analysis.getRequest(), "verify")
+    if not provides(IRequestAnalysis, analysis):
+        return
+
+    sample = analysis.getRequest()
 
-        # Try submit (remaining analyses are in 'to_be_verified')
-        doActionFor(analysis.getRequest(), "submit")
+    # Try with the transitions below in order and stop at the first one that
+    # succeeds, cause the sample can only be transitioned once:
+    # - verify: for when remaining analyses are in 'verified'
+    # - submit: for when remaining analyses are in 'to_be_verified'
+    # - rollback_to_receive: no remaining analyses or some not submitted
+    for transition_id in ["verify", "submit", "rollback_to_receive"]:
+        succeed, message = doActionFor(sample, transition_id)
+        if succeed:
+            break
 
-        # Try rollback (no remaining analyses or some not submitted)
-        doActionFor(analysis.getRequest(), "rollback_to_receive")
-        reindex_request(analysis)
+    reindex_request(analysis, sample=sample)
 
 
 def after_verify(analysis):
@@ -225,22 +314,26 @@ def after_verify(analysis):
     promote_to_dependencies(analysis, "verify")
 
     # Promote transition to worksheet
-    ws = analysis.getWorksheet()
+    ws = get_worksheet(analysis)
     if ws:
         doActionFor(ws, "verify")
         ws.reindexObject()
 
     # Promote transition to Analysis Request if Sample auto-verify is enabled
-    if IRequestAnalysis.providedBy(analysis) and check_all_verified(analysis):
+    if not provides(IRequestAnalysis, analysis):
+        return
+
+    sample = analysis.getRequest()
+    if check_all_verified(analysis, sample=sample):
         setup = api.get_setup()
         if setup.getAutoVerifySamples():
-            doActionFor(analysis.getRequest(), "verify")
+            doActionFor(sample, "verify")
 
         # Reindex the sample (and ancestors) this analysis belongs to
-        reindex_request(analysis)
+        reindex_request(analysis, sample=sample)
 
 
-def check_all_verified(analysis):
+def check_all_verified(analysis, sample=None):
     """Checks if all analyses are verified
 
     NOTE: This check is provided solely for performance reasons of the `verify`
@@ -251,30 +344,37 @@ def check_all_verified(analysis):
     automatically verified and needs to be transitioned manually.
 
     :param analysis: The current verified analysis
+    :param sample: The sample of the analysis, resolved if not passed in
     :returns: True if all other routine analyses of the sample are verified
     """
 
     parent = api.get_parent(analysis)
-    sample = analysis.getRequest()
+    if sample is None:
+        sample = analysis.getRequest()
     uid = api.get_uid(analysis)
 
-    def is_valid(an):
-        state = api.get_review_status(an)
-        return state not in [STATE_REJECTED, STATE_RETRACTED]
-
-    # get all *valid* analyses of the sample
-    analyses = filter(is_valid, sample.getAnalyses())
-    # get all *verified* analyses of the sample
-    verified = sample.getAnalyses(object_provides=IVerified.__identifier__)
-
-    # NOTE: We remove the current processed routine analysis (if not a WS
+    # NOTE: We skip the current processed routine analysis (if not a WS
     #       duplicate/reference analysis), because it is either not yet
     #       verified or processed already in multi-verify scenarios.
-    if sample == parent:
-        analyses = filter(lambda x: api.get_uid(x) != uid, analyses)
-        verified = filter(lambda x: api.get_uid(x) != uid, verified)
-
-    return len(analyses) == len(verified)
+    skip_uid = uid if sample == parent else None
+
+    # Check the analyses of the sample with a single catalog query. Only
+    # analyses in "verified" or "published" status provide `IVerified`, so
+    # there is no need to query the catalog again by `object_provides`.
+    # Bind the lookups done on each iteration to local names
+    get_uid = api.get_uid
+    get_review_status = api.get_review_status
+    for brain in sample.getAnalyses():
+        if get_uid(brain) == skip_uid:
+            continue
+        state = get_review_status(brain)
+        if state in INVALID_STATES:
+            continue
+        if state not in VERIFIED_STATES:
+            # Valid analysis not yet verified
+            return False
+
+    return True
 
 
 def after_publish(analysis):
@@ -284,29 +384,141 @@ def after_publish(analysis):
 
 
 # TODO Workflow - Analysis - revisit reindexing of ancestors
-def reindex_request(analysis, idxs=None):
+def reindex_request(analysis, idxs=None, sample=None):
     """Reindex the Analysis Request the analysis belongs to, as well as the
-    ancestors recursively
+    ancestors recursively. The Analysis Request is resolved from the analysis
+    unless passed in as `sample`. Only the indexes passed in as `idxs` are
+    reindexed, or all of them if None
     """
-    if not IRequestAnalysis.providedBy(analysis) or \
-            IDuplicateAnalysis.providedBy(analysis):
+    if not provides(IRequestAnalysis, analysis) or \
+            provides(IDuplicateAnalysis, analysis):
         # Analysis not directly bound to an Analysis Request. Do nothing
         return
 
-    request = analysis.getRequest()
-    ancestors = [request] + request.getAncestors(all_ancestors=True)
+    if sample is None:
+        sample = analysis.getRequest()
+    ancestors = [sample] + sample.getAncestors(all_ancestors=True)
+
+    queue = get_reindex_queue()
+    if queue is not None:
+        # A cascade is in progress, reindex once when it finishes
+        for ancestor in ancestors:
+            queue_reindex(queue, ancestor, idxs)
+        return
+
     for ancestor in ancestors:
-        ancestor.reindexObject()
+        reindex(ancestor, idxs)
+
+
+def reindex(obj, idxs=None):
+    """Reindex the indexes passed in for the given object, or all of them if
+    None
+    """
+    if idxs:
+        obj.reindexObject(idxs=list(idxs))
+    else:
+        obj.reindexObject()
+
+
+def queue_reindex(queue, obj, idxs=None):
+    """Adds the object to the reindex queue passed in. If the object is queued
+    already, the indexes are merged, being None a full reindex
+    """
+    uid = api.get_uid(obj)
+    if uid not in queue:
+        queue[uid] = (obj, idxs and set(idxs) or None)
+        return
+
+    queued_obj, queued_idxs = queue[uid]
+    if queued_idxs is not None and idxs:
+        queue[uid] = (queued_obj, queued_idxs.union(idxs))
+    else:
+        queue[uid] = (queued_obj, None)
+
+
+def get_reindex_queue():
+    """Returns the queue of samples pending to be reindexed by the cascade in
+    progress, if any
+    """
+    cascade = get_cascade()
+    if cascade is None:
+        return None
+    return cascade["reindex"]
+
+
+def get_cascade():
+    """Returns the data of the transitions cascade in progress, if any
+    """
+    request = api.get_request()
+    if request is None:
+        return None
+    return IAnnotations(request).get(CASCADE_KEY)
+
+
+@contextmanager
+def transitions_cascade():
+    """Keeps track of the analyses transitioned within this context and defers
+    the reindex of the samples and ancestors they belong to, so each one is
+    reindexed only once when the outermost cascade finishes
+    """
+    cascade = get_cascade()
+    if cascade is not None:
+        # Nested cascade
+        yield cascade
+        return
+
+    cascade = {
+        "reindex": OrderedDict(),
+        "transitioned": set(),
+    }
+    request = api.get_request()
+    if request is None:
+        # No request available, nothing can be deferred
+        yield cascade
+        return
+
+    annotations = IAnnotations(request)
+    annotations[CASCADE_KEY] = cascade
+    try:
+        yield cascade
+    finally:
+        annotations.pop(CASCADE_KEY, None)
+
+    for ancestor, idxs in cascade["reindex"].values():
+        reindex(ancestor, idxs)
+
+
+def cascade_transition(analyses, transition_id):
+    """Performs the transition to the analyses passed in, but skips those that
+    were already transitioned within the cascade in progress
+    """
+    # local names for the lookups done on each iteration
+    get_uid = api.get_uid
+    do_action_for = doActionFor
+
+    with transitions_cascade() as cascade:
+        transitioned = cascade["transitioned"]
+        for analysis in analyses:
+            key = (get_uid(analysis), transition_id)
+            if key in transitioned:
+                continue
+            succeed, message = do_action_for(analysis, transition_id)
+            if succeed:
+                transitioned.add(key)
 
 
 def remove_analysis_from_worksheet(analysis):
     """Removes the analysis passed in from the worksheet, if assigned to any
     """
-    worksheet = analysis.getWorksheet()
+    worksheet = get_worksheet(analysis)
     if not worksheet:
         return
 
-    analyses = filter(lambda an: an != analysis, worksheet.getAnalyses())
+    # Compare the unwrapped objects, cause the analyses returned by the
+    # worksheet are not wrapped in the same acquisition chain
+    base = aq_base(analysis)
+    analyses = [an for an in worksheet.getAnalyses()
+                if aq_base(an) is not base]
     worksheet.setAnalyses(analyses)
     worksheet.purgeLayout()
     if analyses:
@@ -327,13 +539,11 @@ def cascade_to_dependents(analysis, transition_id):
     """Cascades the transition to dependent analyses (those that depend on the
     analysis passed in), if any
     """
-    for dependent in analysis.getDependents():
-        doActionFor(dependent, transition_id)
+    cascade_transition(analysis.getDependents(), transition_id)
 
 
 def promote_to_dependencies(analysis, transition_id):
     """Promotes the transition to the analyses this analysis depends on
     (dependencies), if any
     """
-    for dependency in analysis.getDependencies():
-        doActionFor(dependency, transition_id)
+    cascade_transition(analysis.getDependencies(), transition_id)